@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import hashlib
 import os
 import pickle
 
@@ -13,12 +14,14 @@ import torch
 from botorch.fit import fit_gpytorch_mll
 from botorch.models import SingleTaskGP
 from botorch.models.gpytorch import GPyTorchModel
-from botorch.sampling.normal import SobolQMCNormalSampler
+from botorch.posteriors.gpytorch import GPyTorchPosterior
+from botorch.utils.sampling import draw_sobol_normal_samples
 from gpytorch.distributions import MultivariateNormal
 # from gpytorch.lazy import PsdSumLazyTensor
 from gpytorch.likelihoods import LikelihoodList
 from gpytorch.mlls import ExactMarginalLogLikelihood
 from gpytorch.models import GP
+from linear_operator.utils.cholesky import psd_safe_cholesky
 from olympus import ParameterSpace, ParameterVector
 from torch.nn import ModuleList
 
@@ -42,6 +45,65 @@ warnings.filterwarnings("ignore", "^.*jitter.*", category=RuntimeWarning)
 torch.set_default_dtype(torch.double)
 
 
+def _rank_loss_3d(f_samps, y_less):
+    """Ranking loss of `... x num_samples x n x n` samples, whose diagonals hold
+    the out-of-sample predictions, given the pairwise order `y_less` of the targets
+    """
+    return (
+        (f_samps.diagonal(dim1=-2, dim2=-1).unsqueeze(-1) < f_samps) ^ y_less
+    ).sum(dim=(-2, -1))
+
+
+class _LazyCompiled:
+    """Compile `fn` with torch.compile on first use if `enabled`. Falls back to
+    running `fn` eagerly if torch.compile is not available, or fails in this
+    environment
+    """
+
+    def __init__(self, fn, enabled=True, **compile_kwargs):
+        self.fn = fn
+        self.compile_kwargs = compile_kwargs
+        self.compiled_fn = None
+        self.compile_errors = ()
+        self.use_eager = not enabled or not hasattr(torch, "compile")
+
+    def _fall_back(self):
+        Logger.log(
+            f"Could not compile {self.fn.__name__}, falling back to eager mode",
+            "WARNING",
+        )
+        self.use_eager = True
+
+    def __call__(self, *args):
+        if not self.use_eager and self.compiled_fn is None:
+            try:
+                # raises for unsupported python versions and platforms
+                self.compiled_fn = torch.compile(
+                    self.fn, **self.compile_kwargs
+                )
+                from torch._dynamo.exc import (
+                    BackendCompilerFailed,
+                    TorchDynamoException,
+                )
+
+                # any dynamo error (e.g. Unsupported, InternalTorchDynamoError)
+                # or backend failure on first call, the eager call still works
+                self.compile_errors = (
+                    BackendCompilerFailed,
+                    TorchDynamoException,
+                )
+            except (RuntimeError, ImportError):
+                self._fall_back()
+        if not self.use_eager:
+            try:
+                return self.compiled_fn(*args)
+            except self.compile_errors:
+                # e.g. no C++ compiler available for the backend, errors of
+                # `fn` itself are raised again by the eager call below
+                self._fall_back()
+        return self.fn(*args)
+
+
 class RGPEPlanner(BasePlanner):
     """Wrapper for the Rank-Weighted GP Ensemble (RGPE)
     https://arxiv.org/pdf/1802.02219.pdf
@@ -49,7 +111,18 @@ class RGPEPlanner(BasePlanner):
     Args:
         cache_weights (bool): save the weights of the RGPE procedure to disk for
                 a posteriori analysis
-        weights_path (str): the directory in which to save the weights, if cache_weights=True
+        weights_path (str): the directory in which to save the weights, if cache_weights=True.
+                The weights are appended to disk each iteration and can be read back
+                with RGPEPlanner.load_rank_weights
+        cache_source_models (bool): save the hyperparameters of the fitted source models
+                to weights_path, and reuse them instead of refitting the source models
+                whenever a planner is created with the same train_tasks
+        device (str): device on which the batched LOOCV target model is fit and sampled.
+                Defaults to "cuda" if available, otherwise "cpu"
+        compile_ranking_loss (bool): compile the ranking loss with torch.compile on
+                first use. Off by default, the compilation takes seconds while the
+                eager ranking loss of a few dozen target observations takes
+                microseconds
     """
 
     def __init__(
@@ -84,9 +157,12 @@ class RGPEPlanner(BasePlanner):
         # meta-learning stuff
         cache_weights: bool = False,
         weights_path: str = "./weights/",
+        cache_source_models: bool = False,
         train_tasks: List = [],
         valid_tasks: Optional[List] = None,
         hyperparams: Optional[Dict] = {},
+        device: Optional[str] = None,
+        compile_ranking_loss: bool = False,
         **kwargs,
     ):
         local_args = {
@@ -97,6 +173,7 @@ class RGPEPlanner(BasePlanner):
         # meta learning stuff
         self.cache_weights = cache_weights
         self.weights_path = weights_path
+        self.cache_source_models = cache_source_models
         self.hyperparams = hyperparams
         self._train_tasks = train_tasks
         self._valid_tasks = valid_tasks
@@ -104,7 +181,25 @@ class RGPEPlanner(BasePlanner):
         self.all_rank_weights = []
         self.all_ranking_losses = []
 
-        self.device = "cpu"
+        # NOTE: only the batched LOOCV model is placed on this device, batched
+        # Cholesky factorizations benefit from the GPU while the single-matrix
+        # target and source model fits are kept on the CPU
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+
+        # generator for the seeds of the QMC base samples, such that every
+        # model gets independent draws that are reproducible for a given seed
+        self._seed_generator = torch.Generator().manual_seed(
+            int(self.random_seed)
+        )
+        # posteriors of the source models over the target task training points,
+        # keyed by id of the (batched) source model
+        self._posterior_cache: Dict[int, Dict[str, torch.Tensor]] = {}
+        # ranking loss kernel, compiled on first use if compile_ranking_loss
+        self._rank_loss_3d = _LazyCompiled(
+            _rank_loss_3d, enabled=compile_ranking_loss, dynamic=True
+        )
 
         # # NOTE: for maximization, we must flip the signs of the
         # source task values before scaling them
@@ -133,6 +228,27 @@ class RGPEPlanner(BasePlanner):
 
         Logger.log_chapter(title='Initial design phase')
 
+    @staticmethod
+    def load_rank_weights(weights_path: str = "./weights/") -> Dict[str, List]:
+        """Load the rank weights and ranking losses cached to disk by a planner
+        with cache_weights=True
+        Args:
+                weights_path (str): the directory in which the weights were saved
+        Returns:
+                dict: the weights and losses of each iteration under the keys
+                        "weights" and "losses"
+        """
+        all_rank_weights, all_ranking_losses = [], []
+        with open(os.path.join(weights_path, "rank_weights.pkl"), "rb") as f:
+            while True:
+                try:
+                    record = pickle.load(f)
+                except EOFError:
+                    break
+                all_rank_weights.append(record["weights"])
+                all_ranking_losses.append(record["losses"])
+        return {"weights": all_rank_weights, "losses": all_ranking_losses}
+
     def _get_fitted_model(self, train_X, train_Y, state_dict=None):
         """Get a fixed noise single task GP. The GP model will be fit unless
         a state_dict containing model hyperparameters is passed
@@ -149,65 +265,372 @@ class RGPEPlanner(BasePlanner):
 
         return model
 
+    def _get_source_models_path(self):
+        """Path of the cached source model hyperparameters, keyed by a hash of
+        the (scaled) source task data
+        """
+        tasks_hash = hashlib.sha1(
+            pickle.dumps(
+                [
+                    (
+                        np.shape(task["params"]),
+                        np.asarray(task["params"]).tobytes(),
+                        np.shape(task["values"]),
+                        np.asarray(task["values"]).tobytes(),
+                    )
+                    for task in self._train_tasks
+                ]
+            )
+        ).hexdigest()
+        return os.path.join(self.weights_path, f"source_gp_{tasks_hash}.pt")
+
     def _get_source_models(self):
-        source_models = []
+        """Fit a GP to each source task. Source tasks with the same number of
+        observations are stacked and fit jointly as a single batched GP, which is
+        then split back into one GP per task. A single batched GP over all source
+        tasks is kept for drawing samples from all source models at once. If
+        cache_source_models=True, the hyperparameters are loaded from (or saved
+        to) disk instead
+        """
+        if self.cache_source_models:
+            path = self._get_source_models_path()
+            if os.path.isfile(path):
+                try:
+                    source_models = self._load_source_models(path)
+                except (
+                    RuntimeError,
+                    ValueError,
+                    EOFError,
+                    pickle.UnpicklingError,
+                ) as e:
+                    # e.g. the hyperparameter names changed with the BoTorch
+                    # version, refit the source models and overwrite the file
+                    Logger.log(
+                        f"Could not load source models from {path} ({e}), "
+                        "refitting them",
+                        "WARNING",
+                    )
+                else:
+                    Logger.log(
+                        f"Loaded {len(source_models)} source models from "
+                        f"{path}",
+                        "INFO",
+                    )
+                    self._set_batched_source_model(source_models)
+                    return source_models
+
+        # group the source tasks by the shapes of their training data
+        groups = {}
         for task_ix, task in enumerate(self._train_tasks):
-            Logger.log(f"Fitting source model {task_ix}", "INFO")
-            source_models.append(
-                self._get_fitted_model(
-                    torch.tensor(task["params"]),
-                    torch.tensor(task["values"]),
-                )
+            key = (np.shape(task["params"]), np.shape(task["values"]))
+            groups.setdefault(key, []).append(task_ix)
+
+        source_models = [None] * len(self._train_tasks)
+        batched_models = []
+        for task_ixs in groups.values():
+            train_X = torch.stack(
+                [
+                    torch.tensor(self._train_tasks[ix]["params"])
+                    for ix in task_ixs
+                ]
+            )
+            train_Y = torch.stack(
+                [
+                    torch.tensor(self._train_tasks[ix]["values"])
+                    for ix in task_ixs
+                ]
             )
+            batched_model = self._get_fitted_model(train_X, train_Y)
+            batched_models.append(batched_model)
+            for batch_ix, task_ix in enumerate(task_ixs):
+                source_models[task_ix] = self._split_batched_model(
+                    batched_model,
+                    batch_ix,
+                    train_X[batch_ix],
+                    train_Y[batch_ix],
+                )
+
+        Logger.log(f"Fitted {len(self._train_tasks)} source models", "INFO")
+
+        if self.cache_source_models:
+            os.makedirs(self.weights_path, exist_ok=True)
+            torch.save([model.state_dict() for model in source_models], path)
+
+        if len(batched_models) == 1:
+            # all source tasks were fit as one batched GP
+            self._batched_source_model = batched_models[0]
+            self._source_train_mask = None
+        else:
+            self._set_batched_source_model(source_models)
         return source_models
 
+    def _load_source_models(self, path):
+        """Build the source models from the hyperparameters saved at `path`"""
+        state_dicts = torch.load(path, weights_only=True)
+        if len(state_dicts) != len(self._train_tasks):
+            raise ValueError(
+                f"Expected {len(self._train_tasks)} source models, "
+                f"found {len(state_dicts)}"
+            )
+        return [
+            self._get_fitted_model(
+                torch.tensor(task["params"]),
+                torch.tensor(task["values"]),
+                state_dict=state_dict,
+            )
+            for task, state_dict in zip(self._train_tasks, state_dicts)
+        ]
+
+    def _set_batched_source_model(self, source_models):
+        """Set the batched GP over all source tasks (in task order), tasks with
+        fewer observations are padded and masked out by `_source_train_mask`
+        """
+        self._batched_source_model, self._source_train_mask = None, None
+        if len(source_models) > 0:
+            (
+                self._batched_source_model,
+                train_mask,
+            ) = self._stack_source_models(source_models)
+            if not train_mask.all():
+                self._source_train_mask = train_mask
+
     @staticmethod
-    def roll_col(X, shift):
-        """roll columns to the right by `shift` indices"""
-        return torch.cat((X[..., -shift:], X[..., :-shift]), dim=-1)
+    def _stack_source_models(source_models):
+        """Stack fitted GPs with different numbers of observations into a single
+        batched GP. The training data of each GP is padded to the largest number
+        of observations, the returned `T x m` mask is False for the padded points
+        """
+        num_models = len(source_models)
+        max_obs = max(
+            model.train_inputs[0].shape[-2] for model in source_models
+        )
+        ref_X = source_models[0].train_inputs[0]
+        train_X = ref_X.new_zeros(num_models, max_obs, ref_X.shape[-1])
+        train_targets = ref_X.new_zeros(num_models, max_obs)
+        train_mask = torch.zeros(num_models, max_obs, dtype=torch.bool)
+        for model_ix, model in enumerate(source_models):
+            num_obs = model.train_inputs[0].shape[-2]
+            train_X[model_ix, :num_obs] = model.train_inputs[0]
+            train_targets[model_ix, :num_obs] = model.train_targets
+            train_mask[model_ix, :num_obs] = True
+
+        batched_model = SingleTaskGP(train_X, train_targets.unsqueeze(-1))
+        state_dicts = [model.state_dict() for model in source_models]
+        batched_model.load_state_dict(
+            {
+                name: (
+                    torch.stack([sd[name] for sd in state_dicts])
+                    if t.ndim > state_dicts[0][name].ndim
+                    else state_dicts[0][name]
+                )
+                for name, t in batched_model.state_dict().items()
+            }
+        )
+        # the targets of the source models are already transformed
+        batched_model.set_train_data(targets=train_targets, strict=False)
+        return batched_model, train_mask
+
+    @staticmethod
+    def _split_batched_model(batched_model, batch_ix, train_X, train_Y):
+        """Build a non-batched GP from the `batch_ix`-th element of a fitted
+        batched GP
+        """
+        model = SingleTaskGP(train_X, train_Y)
+        ref_state_dict = model.state_dict()
+        state_dict = {
+            name: t[batch_ix] if t.ndim > ref_state_dict[name].ndim else t
+            for name, t in batched_model.state_dict().items()
+        }
+        model.load_state_dict(state_dict)
+        return model
+
+    def _get_base_posterior(self, model, train_x, train_mask=None):
+        """Posterior of a fitted (batched) base model over the target task
+        training points. The base models do not change once fit, and the training
+        points usually only grow by a few points per iteration, so the posterior of
+        the previous call is cached and only extended by the newly added points.
+        The cached quantities are kept in the dtype of the model, the returned
+        (untransformed) posterior is cast to the dtype of `train_x`. Padded
+        training points of the model, i.e. False entries of `train_mask`, do not
+        contribute to the posterior
+        """
+        train_X = model.train_inputs[0]
+        dtype = train_x.dtype
+        train_x = train_x.to(train_X)
+
+        if hasattr(model, "input_transform"):
+            if train_mask is not None:
+                raise ValueError(
+                    "Padded training data is not supported for base models with an input transform"
+                )
+            with torch.no_grad():
+                posterior = model.posterior(train_x)
+            return self._cast_posterior(posterior, dtype)
+
+        def train_covar(x):
+            # covariance between the training points of the model and `x`
+            covar = model.covar_module(train_X, x).to_dense()
+            if train_mask is not None:
+                covar = covar * train_mask.unsqueeze(-1)
+            return covar
+
+        with torch.no_grad():
+            cache = self._posterior_cache.get(id(model))
+            if cache is None:
+                # factorize the kernel matrix of the source task data once
+                batch_shape, m = train_X.shape[:-2], train_X.shape[-2]
+                covar = train_covar(train_X)
+                noise = model.likelihood.noise.expand(*batch_shape, m)
+                resid = model.train_targets - model.mean_module(train_X)
+                if train_mask is not None:
+                    # with a unit diagonal and no covariance to the observed
+                    # points, the padded block of the Cholesky factor is the
+                    # identity and the padded points have no effect
+                    noise = torch.where(
+                        train_mask, noise, torch.ones_like(noise)
+                    )
+                    covar = covar * train_mask.unsqueeze(-2)
+                    resid = resid * train_mask
+                chol = psd_safe_cholesky(covar + torch.diag_embed(noise))
+                cache = {
+                    "chol": chol,
+                    "alpha": torch.linalg.solve_triangular(
+                        chol, resid.unsqueeze(-1), upper=False
+                    ),
+                }
+                self._posterior_cache[id(model)] = cache
+
+            # check if the training points extend those of the previous call
+            n_old = 0
+            if "x" in cache:
+                n_old = cache["x"].shape[0]
+                if n_old > train_x.shape[0] or not torch.equal(
+                    train_x[:n_old], cache["x"]
+                ):
+                    n_old = 0
+            x_new = train_x[n_old:]
+
+            if x_new.shape[0] > 0:
+                # proj = L^-1 K(X, x) for the source task data X
+                proj_new = torch.linalg.solve_triangular(
+                    cache["chol"],
+                    train_covar(x_new),
+                    upper=False,
+                )
+                mean_new = model.mean_module(x_new) + (
+                    proj_new * cache["alpha"]
+                ).sum(dim=-2)
+                covar_new = (
+                    model.covar_module(x_new).to_dense()
+                    - proj_new.transpose(-1, -2) @ proj_new
+                )
+                if n_old == 0:
+                    proj, mean, covar = proj_new, mean_new, covar_new
+                else:
+                    # extend the cached posterior by the new rows/columns
+                    cross = (
+                        model.covar_module(cache["x"], x_new).to_dense()
+                        - cache["proj"].transpose(-1, -2) @ proj_new
+                    )
+                    proj = torch.cat([cache["proj"], proj_new], dim=-1)
+                    mean = torch.cat([cache["mean"], mean_new], dim=-1)
+                    covar = torch.cat(
+                        [
+                            torch.cat([cache["covar"], cross], dim=-1),
+                            torch.cat(
+                                [cross.transpose(-1, -2), covar_new], dim=-1
+                            ),
+                        ],
+                        dim=-2,
+                    )
+                cache.update(x=train_x, proj=proj, mean=mean, covar=covar)
+
+        posterior = GPyTorchPosterior(
+            MultivariateNormal(cache["mean"], cache["covar"])
+        )
+        if hasattr(model, "outcome_transform"):
+            posterior = model.outcome_transform.untransform_posterior(
+                posterior
+            )
+        return self._cast_posterior(posterior, dtype)
+
+    @staticmethod
+    def _cast_posterior(posterior, dtype):
+        """Cast a GPyTorch posterior to `dtype`"""
+        mvn = posterior.distribution
+        return GPyTorchPosterior(
+            MultivariateNormal(
+                mvn.mean.to(dtype), mvn.covariance_matrix.to(dtype)
+            )
+        )
+
+    def _draw_seeds(self, num_seeds):
+        """Draw `num_seeds` seeds for the QMC base samples from the generator of
+        the planner, which is seeded with the random seed of the planner
+        """
+        return torch.randint(
+            0, 2**31 - 1, (num_seeds,), generator=self._seed_generator
+        ).tolist()
+
+    def _sample_posterior(
+        self, posterior, num_samples, seed, share_base_samples=False
+    ):
+        """Draw `num_samples` QMC samples from a `b x n x 1` posterior. The Sobol
+        normal base samples of all batch elements are drawn at once from one
+        engine seeded with `seed`. Each batch element (i.e. model) gets its own
+        Sobol dimensions, such that the samples of different models are
+        independent. With share_base_samples=True, the same base samples are
+        shared by the whole batch instead
+        Returns: `num_samples x b x n`-dim tensor of samples
+        """
+        base_sample_shape = posterior.base_sample_shape
+        sample_shape = base_sample_shape
+        if share_base_samples:
+            sample_shape = (
+                torch.Size([1] * (len(base_sample_shape) - 2))
+                + base_sample_shape[-2:]
+            )
+        base_samples = draw_sobol_normal_samples(
+            d=sample_shape.numel(),
+            n=num_samples,
+            device=posterior.device,
+            dtype=posterior.dtype,
+            seed=seed,
+        )
+        base_samples = base_samples.view(num_samples, *sample_shape).expand(
+            num_samples, *base_sample_shape
+        )
+        return posterior.rsample_from_base_samples(
+            torch.Size([num_samples]), base_samples
+        ).squeeze(-1)
 
     def compute_ranking_loss(self, f_samps, target_y):
         """Compute the ranking loss for each sample from the posterior
-        over the target points
+        over the target points. Any leading dimensions of `f_samps` (e.g. one
+        per model) are treated as batch dimensions
         Args:
-                f_samps (torch.Tensor): samples of shape (num_samples, n, num_dim)
-                target_y (torch.Tensor): tensor containing targets of shape (num_dim, 1)
+                f_samps (torch.Tensor): samples of shape (..., num_samples, n, n), where
+                        the diagonal holds the out-of-sample predictions of each LOO
+                        model, or samples of shape (num_samples, n) from a base model
+                target_y (torch.Tensor): tensor containing targets of shape (n, 1)
         Returns:
                 rank_loss (torch.Tensor): tensor containing the ranking loss for each
-                        sample shape (num_samples)
+                        sample shape (..., num_samples)
         """
         n = target_y.shape[0]
-        if f_samps.ndim == 3:
-            # Compute ranking loss for target model
-            # take cartesian product of target_y
-            cartesian_y = torch.cartesian_prod(
-                target_y.squeeze(-1),
-                target_y.squeeze(-1),
-            ).view(n, n, 2)
-            # the diagonal of f_samps are the out-of-sample predictions
-            # for each LOO model, compare the out of sample predictions to each in-sample prediction
-            rank_loss = (
-                (
-                    (f_samps.diagonal(dim1=1, dim2=2).unsqueeze(-1) < f_samps)
-                    ^ (cartesian_y[..., 0] < cartesian_y[..., 1])
-                )
-                .sum(dim=-1)
-                .sum(dim=-1)
-            )
-        else:
-            rank_loss = torch.zeros(
-                f_samps.shape[0], dtype=torch.long, device=target_y.device
-            )
-            y_stack = target_y.squeeze(-1).expand(f_samps.shape)
-            for i in range(1, target_y.shape[0]):
-                rank_loss += (
-                    (self.roll_col(f_samps, i) < f_samps)
-                    ^ (self.roll_col(y_stack, i) < y_stack)
-                ).sum(dim=-1)
-        return rank_loss
+        if f_samps.ndim == 2:
+            # samples from a base model make the same prediction for every
+            # row, its diagonal is then the prediction at each point
+            f_samps = f_samps.unsqueeze(-2).expand(*f_samps.shape[:-1], n, n)
+        # pairwise order of the targets, y_less[i, j] = y[i] < y[j]
+        y = target_y.squeeze(-1)
+        y_less = y.unsqueeze(1) < y.unsqueeze(0)
+        # the diagonal of f_samps are the out-of-sample predictions
+        # for each LOO model, compare the out of sample predictions to each in-sample prediction
+        return self._rank_loss_3d(f_samps, y_less)
 
     def get_target_model_loocv_sample_preds(
-        self, train_x, train_y, target_model, num_samples
+        self, train_x, train_y, target_model, num_samples, seed=None
     ):
         """
         Create a batch-mode LOOCV GP and draw a joint sample across all points from the target task.
@@ -216,21 +639,30 @@ class RGPEPlanner(BasePlanner):
                 train_y: `n x 1` tensor of training targets
                 target_model: fitted target model
                 num_samples: number of mc samples to draw
+                seed: seed for the QMC base samples, drawn from the generator of the
+                        planner if not provided
         Return: `num_samples x n x n`-dim tensor of samples, where dim=1 represents the `n` LOO models,
                 and dim=2 represents the `n` training points.
         """
+        train_x = train_x.to(device=self.device, dtype=torch.float32)
+        train_y = train_y.to(device=self.device, dtype=torch.float32)
         batch_size = len(train_x)
-        masks = torch.eye(
-            len(train_x), dtype=torch.uint8, device=self.device
-        ).bool()
-        train_x_cv = torch.stack([train_x[~m] for m in masks])
-        train_y_cv = torch.stack([train_y[~m] for m in masks])
+        # `n x (n-1)` indices of the points kept by each LOO model
+        idx = torch.arange(batch_size, device=self.device)
+        loo_mask = ~torch.eye(batch_size, dtype=torch.bool, device=self.device)
+        keep = (
+            idx.unsqueeze(0)
+            .expand(batch_size, batch_size)[loo_mask]
+            .view(batch_size, batch_size - 1)
+        )
+        train_x_cv = train_x[keep]
+        train_y_cv = train_y[keep]
         # train_yvar_cv = torch.stack([train_yvar[~m] for m in masks])
-        state_dict = target_model.state_dict()
-        # expand to batch size of batch_mode LOOCV model
         state_dict_expanded = {
-            name: t.expand(batch_size, *[-1 for _ in range(t.ndim)])
-            for name, t in state_dict.items()
+            name: t.to(device=self.device, dtype=torch.float32).expand(
+                batch_size, *[-1 for _ in range(t.ndim)]
+            )
+            for name, t in target_model.state_dict().items()
         }
         model = self._get_fitted_model(
             train_x_cv, train_y_cv, state_dict=state_dict_expanded
@@ -239,57 +671,96 @@ class RGPEPlanner(BasePlanner):
             posterior = model.posterior(train_x)
             # Since we have a batch mode gp and model.posterior always returns an output dimension,
             # the output from `posterior.sample()` here `num_samples x n x n x 1`, so let's squeeze
-            # the last dimension.
-            sampler = SobolQMCNormalSampler(
-                sample_shape=torch.tensor([num_samples]).size()
-            )
-            return sampler(posterior).squeeze(-1)
+            # the last dimension. All LOO models share the same base samples.
+            if seed is None:
+                seed = self._draw_seeds(1)[0]
+            return self._sample_posterior(
+                posterior, num_samples, seed, share_base_samples=True
+            ).cpu()
 
     def compute_rank_weights(
-        self, train_x, train_y, base_models, target_model, num_samples
+        self,
+        train_x,
+        train_y,
+        base_models,
+        target_model,
+        num_samples,
+        base_train_mask=None,
     ):
         """Compute ranking weights for each base model and the target model (using
         LOOCV for the target model). Note: This implementation does not currently
         address weight dilution, since we only have a small number of base models.
+        With fewer than 3 target observations the ranking losses carry almost no
+        information (and the LOOCV models have at most one training point), so
+        the ranking is skipped and every model receives the same weight.
         Args:
                 train_x: `n x d` tensor of training points (for target task)
                 train_y: `n` tensor of training targets (for target task)
-                base_models: list of `n_t` base models
+                base_models: batched GP with batch shape `T` over all `T` base tasks,
+                        or None if there are no base tasks
+                target_model: fitted target model
                 num_samples: number of mc samples
+                base_train_mask: `T x m` mask of the observed training points
+                        of `base_models`, if their training data is padded
         Returns:
-                Tensor: `n_t`-dim tensor with the ranking weight for each model
+                Tensor: `(T + 1)`-dim tensor with the ranking weight for each model
         """
-        ranking_losses = []
-        # compute ranking loss for each base model
-        for task_ix in range(len(base_models)):
-            model = base_models[task_ix]
-            # compute posterior over training points for target task
-            posterior = model.posterior(train_x)
-            sampler = SobolQMCNormalSampler(
-                sample_shape=torch.tensor([num_samples]).size()
+        num_base_models = (
+            0 if base_models is None else base_models.train_inputs[0].shape[0]
+        )
+        if train_x.shape[0] < 3:
+            rank_weights = torch.full(
+                (num_base_models + 1,),
+                1.0 / (num_base_models + 1),
+                dtype=train_x.dtype,
             )
-            base_f_samps = sampler(posterior).squeeze(-1).squeeze(-1)
-            # compute and save ranking loss
-            ranking_losses.append(
-                self.compute_ranking_loss(base_f_samps, train_y)
+            ranking_loss_tensor = torch.zeros(
+                (num_base_models + 1, num_samples), dtype=torch.long
             )
+            return rank_weights, ranking_loss_tensor
+        # the ranking losses only depend on the order of the samples, so the
+        # posteriors are sampled in single precision (no copy is made if the
+        # inputs are already float32)
+        train_x = train_x.to(torch.float32)
+        train_y = train_y.to(torch.float32)
+        # one Sobol engine for all base models and one for the target model,
+        # the base models draw from their own dimensions of the first engine
+        base_seed, target_seed = self._draw_seeds(2)
+        n = train_x.shape[0]
+        # `num_samples x n x n` samples for each base model and the target model
+        f_samps = torch.empty(
+            (num_base_models + 1, num_samples, n, n),
+            dtype=train_x.dtype,
+            device=train_x.device,
+        )
+        if base_models is not None:
+            # compute a single batched posterior over training points for
+            # target task for all base models
+            posterior = self._get_base_posterior(
+                base_models, train_x, train_mask=base_train_mask
+            )
+            # `num_samples x T x n`
+            base_f_samps = self._sample_posterior(
+                posterior, num_samples, base_seed
+            )
+            # every row of a base model sample holds the same predictions
+            f_samps[:-1] = base_f_samps.transpose(0, 1).unsqueeze(-2)
         # compute ranking loss for target model using LOOCV
         # f_samps
-        target_f_samps = self.get_target_model_loocv_sample_preds(
+        f_samps[-1] = self.get_target_model_loocv_sample_preds(
             train_x,
             train_y,
             target_model,
             num_samples,
+            seed=target_seed,
         )
-        ranking_losses.append(
-            self.compute_ranking_loss(target_f_samps, train_y)
-        )
-        ranking_loss_tensor = torch.stack(ranking_losses)
+        # compute the ranking losses of all models at once
+        ranking_loss_tensor = self.compute_ranking_loss(f_samps, train_y)
         # compute best model (minimum ranking loss) for each sample
         best_models = torch.argmin(ranking_loss_tensor, dim=0)
         # compute proportion of samples for which each model is best
         rank_weights = (
-            best_models.bincount(minlength=len(ranking_losses)).type_as(
+            best_models.bincount(minlength=num_base_models + 1).type_as(
                 train_x
             )
             / num_samples
@@ -304,9 +775,9 @@ class RGPEPlanner(BasePlanner):
             self.source_models = self._get_source_models()
 
         # if we have all nan values, just keep randomly sampling
-        if np.logical_or(
-            len(self._values) < self.num_init_design,
-            np.all(np.isnan(self._values)),
+        if (
+            len(self._values) < self.num_init_design
+            or not np.isfinite(self._values).any()
         ):
             return_params = self.initial_design()
 
@@ -343,12 +814,16 @@ class RGPEPlanner(BasePlanner):
                 self.train_x_scaled_reg, self.train_y_scaled_reg
             )
             model_list = self.source_models + [target_model]
+            # the rank weights are computed in single precision, cast once
+            train_x_float = self.train_x_scaled_reg.float().contiguous()
+            train_y_float = self.train_y_scaled_reg.float().contiguous()
             rank_weights, ranking_loss_tensor = self.compute_rank_weights(
-                self.train_x_scaled_reg.float(),
-                self.train_y_scaled_reg.float(),
-                self.source_models,
+                train_x_float,
+                train_y_float,
+                self._batched_source_model,
                 target_model,
                 num_samples=10,
+                base_train_mask=self._source_train_mask,
             )
 
             Logger.log_chapter(title='Training regression surrogate model')
@@ -356,21 +831,18 @@ class RGPEPlanner(BasePlanner):
 
             # check to see if we cache the weights and save them to disk
             if self.cache_weights:
-                self.all_rank_weights.append(rank_weights.detach().numpy())
-                self.all_ranking_losses.append(
-                    ranking_loss_tensor.detach().numpy()
-                )
+                weights = rank_weights.detach().cpu().numpy()
+                losses = ranking_loss_tensor.detach().cpu().numpy()
+                self.all_rank_weights.append(weights)
+                self.all_ranking_losses.append(losses)
+                # append one record per iteration, the file is started fresh
+                # on the first iteration of this planner
                 os.makedirs(self.weights_path, exist_ok=True)
+                mode = "ab" if len(self.all_rank_weights) > 1 else "wb"
                 with open(
-                    os.path.join(self.weights_path, "rank_weights.pkl"), "wb"
+                    os.path.join(self.weights_path, "rank_weights.pkl"), mode
                 ) as f:
-                    pickle.dump(
-                        {
-                            "weights": self.all_rank_weights,
-                            "losses": self.all_ranking_losses,
-                        },
-                        f,
-                    )
+                    pickle.dump({"weights": weights, "losses": losses}, f)
 
             # TODO: can probably put this bit in the unknown constraints module
             if (
@@ -406,7 +878,7 @@ class RGPEPlanner(BasePlanner):
 
             # get the incumbent point
             f_best_argmin = torch.argmin(self.train_y_scaled_reg)
-            f_best_scaled = self.train_y_scaled_reg[f_best_argmin][0].float()
+            f_best_scaled = self.train_y_scaled_reg[f_best_argmin, 0]
 
             # compute the ratio of infeasible to total points
             infeas_ratio = (
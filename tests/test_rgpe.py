@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+
+import copy
+
+import numpy as np
+import pytest
+import torch
+from botorch.models import SingleTaskGP
+from botorch.models.transforms import Normalize, Standardize
+from olympus.campaigns import Campaign, ParameterSpace
+from olympus.objects import ParameterContinuous
+
+import atlas.planners.rgpe.planner as rgpe_planner
+from atlas.planners.rgpe.planner import RGPEPlanner, _LazyCompiled
+from atlas.utils.synthetic_data import trig_factory
+
+
+def planner_factory(num_tasks=3, **kwargs):
+    train_tasks = trig_factory(num_samples=num_tasks, as_numpy=True)
+    valid_tasks = trig_factory(num_samples=1, as_numpy=True)
+    return RGPEPlanner(
+        goal="minimize",
+        random_seed=100700,
+        train_tasks=train_tasks,
+        valid_tasks=valid_tasks,
+        **kwargs,
+    )
+
+
+def target_data_factory(num_obs=8):
+    train_x = torch.rand(num_obs, 1, dtype=torch.double)
+    train_y = torch.sin(8 * train_x) + 0.05 * torch.randn_like(train_x)
+    return train_x, train_y
+
+
+def assert_posteriors_close(posterior, ref_posterior):
+    assert torch.allclose(posterior.mean, ref_posterior.mean, atol=1e-6)
+    assert torch.allclose(
+        posterior.distribution.covariance_matrix,
+        ref_posterior.distribution.covariance_matrix,
+        atol=1e-6,
+    )
+
+
+def roll_col(X, shift):
+    """roll columns to the right by `shift` indices"""
+    return torch.cat((X[..., -shift:], X[..., :-shift]), dim=-1)
+
+
+def reference_ranking_loss(f_samps, target_y):
+    """Ranking loss of the original implementation, `num_samples x n` samples
+    of a base model or `num_samples x n x n` samples of the LOOCV models
+    """
+    n = target_y.shape[0]
+    if f_samps.ndim == 3:
+        cartesian_y = torch.cartesian_prod(
+            target_y.squeeze(-1),
+            target_y.squeeze(-1),
+        ).view(n, n, 2)
+        return (
+            (
+                (f_samps.diagonal(dim1=1, dim2=2).unsqueeze(-1) < f_samps)
+                ^ (cartesian_y[..., 0] < cartesian_y[..., 1])
+            )
+            .sum(dim=-1)
+            .sum(dim=-1)
+        )
+    rank_loss = torch.zeros(f_samps.shape[0], dtype=torch.long)
+    y_stack = target_y.squeeze(-1).expand(f_samps.shape)
+    for i in range(1, target_y.shape[0]):
+        rank_loss += (
+            (roll_col(f_samps, i) < f_samps) ^ (roll_col(y_stack, i) < y_stack)
+        ).sum(dim=-1)
+    return rank_loss
+
+
+def test_base_posterior():
+    planner = planner_factory(num_tasks=2)
+    planner._get_source_models()
+    model = planner._batched_source_model
+    train_x, _ = target_data_factory(num_obs=10)
+
+    def check_posterior(x):
+        posterior = planner._get_base_posterior(model, x)
+        with torch.no_grad():
+            ref_posterior = model.posterior(x)
+        assert_posteriors_close(posterior, ref_posterior)
+        assert torch.equal(planner._posterior_cache[id(model)]["x"], x)
+
+    # fresh call
+    check_posterior(train_x[:6])
+    # extension of the cached posterior by new points
+    check_posterior(train_x)
+    # reset after the previous points changed
+    check_posterior(torch.flip(train_x, dims=(0,))[:8])
+
+
+def test_base_posterior_dtype():
+    train_X, train_Y = target_data_factory(num_obs=12)
+    model = SingleTaskGP(train_X, train_Y, outcome_transform=Standardize(m=1))
+    planner = planner_factory(num_tasks=1)
+    train_x, _ = target_data_factory()
+    posterior = planner._get_base_posterior(model, train_x.float())
+    assert posterior.mean.dtype == torch.float32
+
+
+def test_base_posterior_input_transform_with_mask():
+    train_X, train_Y = target_data_factory(num_obs=12)
+    model = SingleTaskGP(train_X, train_Y, input_transform=Normalize(d=1))
+    planner = planner_factory(num_tasks=1)
+    train_x, _ = target_data_factory()
+    train_mask = torch.ones(12, dtype=torch.bool)
+    with pytest.raises(ValueError):
+        planner._get_base_posterior(model, train_x, train_mask=train_mask)
+
+
+def test_base_samples_independent_across_models():
+    planner = planner_factory(num_tasks=1)
+    source_model = planner._get_source_models()[0]
+    # stack the same source model twice, both have identical posteriors
+    batched_model, _ = planner._stack_source_models(
+        [source_model, source_model]
+    )
+    train_x, _ = target_data_factory()
+    posterior = planner._get_base_posterior(batched_model, train_x)
+    samples = planner._sample_posterior(
+        posterior, 16, planner._draw_seeds(1)[0]
+    )
+
+    assert samples.shape == (16, 2, train_x.shape[0])
+    assert not torch.allclose(samples[:, 0], samples[:, 1])
+
+
+def test_target_model_gets_own_seed():
+    planner = planner_factory(num_tasks=2)
+    planner.source_models = planner._get_source_models()
+    train_x, train_y = target_data_factory()
+    target_model = planner._get_fitted_model(train_x, train_y)
+
+    # record the seeds of the base samples of every model
+    used_seeds = []
+    sample_posterior = planner._sample_posterior
+
+    def record_seeds(posterior, num_samples, seed, **kwargs):
+        used_seeds.append(seed)
+        return sample_posterior(posterior, num_samples, seed, **kwargs)
+
+    planner._sample_posterior = record_seeds
+    planner.compute_rank_weights(
+        train_x.float(),
+        train_y.float(),
+        planner._batched_source_model,
+        target_model,
+        num_samples=10,
+        base_train_mask=planner._source_train_mask,
+    )
+
+    # one seed for the batched base models and one for the target model
+    assert len(used_seeds) == 2
+    assert len(set(used_seeds)) == 2
+
+
+def test_stacked_ragged_source_models():
+    planner = planner_factory(num_tasks=1)
+    source_models = []
+    for num_obs in [20, 35, 27]:
+        train_X, train_Y = target_data_factory(num_obs=num_obs)
+        source_models.append(planner._get_fitted_model(train_X, train_Y))
+    batched_model, train_mask = planner._stack_source_models(source_models)
+    assert train_mask.shape == (3, 35)
+    assert train_mask.sum(dim=-1).tolist() == [20, 35, 27]
+
+    train_x, _ = target_data_factory()
+    posterior = planner._get_base_posterior(
+        batched_model, train_x, train_mask=train_mask
+    )
+    for model_ix, model in enumerate(source_models):
+        with torch.no_grad():
+            ref_posterior = model.posterior(train_x)
+        assert torch.allclose(
+            posterior.mean[model_ix], ref_posterior.mean, atol=1e-6
+        )
+        assert torch.allclose(
+            posterior.distribution.covariance_matrix[model_ix],
+            ref_posterior.distribution.covariance_matrix,
+            atol=1e-6,
+        )
+
+
+def test_cached_source_models(tmp_path, monkeypatch):
+    train_tasks = trig_factory(num_samples=2, as_numpy=True)
+    valid_tasks = trig_factory(num_samples=1, as_numpy=True)
+
+    def cached_planner_factory():
+        return RGPEPlanner(
+            goal="minimize",
+            random_seed=100700,
+            train_tasks=copy.deepcopy(train_tasks),
+            valid_tasks=copy.deepcopy(valid_tasks),
+            weights_path=str(tmp_path),
+            cache_source_models=True,
+        )
+
+    source_models = cached_planner_factory()._get_source_models()
+    (path,) = tmp_path.glob("source_gp_*.pt")
+
+    # the second planner loads the source models instead of fitting them
+    def fit_gpytorch_mll(mll):
+        raise AssertionError("source models were refit")
+
+    with monkeypatch.context() as m:
+        m.setattr(rgpe_planner, "fit_gpytorch_mll", fit_gpytorch_mll)
+        loaded_source_models = cached_planner_factory()._get_source_models()
+
+    assert len(loaded_source_models) == len(source_models)
+    for model, loaded_model in zip(source_models, loaded_source_models):
+        state_dict = model.state_dict()
+        loaded_state_dict = loaded_model.state_dict()
+        assert state_dict.keys() == loaded_state_dict.keys()
+        for name, t in state_dict.items():
+            assert torch.equal(t, loaded_state_dict[name])
+
+    # an unreadable file is replaced by refitting the source models
+    path.write_bytes(b"not a state_dict")
+    cached_planner_factory()._get_source_models()
+    assert len(torch.load(path, weights_only=True)) == len(source_models)
+
+
+def run_cached_weights_campaign(weights_path, num_iter, num_init_design=5):
+    param_space = ParameterSpace()
+    param_space.add(ParameterContinuous(name="param_0", low=0.0, high=1.0))
+    planner = planner_factory(
+        num_init_design=num_init_design,
+        cache_weights=True,
+        weights_path=str(weights_path),
+    )
+    planner.set_param_space(param_space)
+    campaign = Campaign()
+    campaign.set_param_space(param_space)
+
+    while len(campaign.observations.get_values()) < num_init_design + num_iter:
+        samples = planner.recommend(campaign.observations)
+        for sample in samples:
+            sample_arr = sample.to_array()
+            campaign.add_observation(sample_arr, np.sin(8 * sample_arr))
+    return planner
+
+
+def test_cached_rank_weights(tmp_path):
+    def check_cached_rank_weights(planner, num_iter):
+        cached = RGPEPlanner.load_rank_weights(str(tmp_path))
+        assert len(cached["weights"]) == num_iter
+        assert len(cached["losses"]) == num_iter
+        for weights, cached_weights in zip(
+            planner.all_rank_weights, cached["weights"]
+        ):
+            assert np.array_equal(weights, cached_weights)
+        for losses, cached_losses in zip(
+            planner.all_ranking_losses, cached["losses"]
+        ):
+            assert np.array_equal(losses, cached_losses)
+
+    planner = run_cached_weights_campaign(tmp_path, num_iter=3)
+    assert len(planner.all_rank_weights) == 3
+    check_cached_rank_weights(planner, num_iter=3)
+
+    # a new planner starts the file afresh instead of appending to it
+    planner = run_cached_weights_campaign(tmp_path, num_iter=1)
+    check_cached_rank_weights(planner, num_iter=1)
+
+
+def test_rank_weights_use_two_sobol_engines(monkeypatch):
+    planner = planner_factory(num_tasks=3)
+    planner.source_models = planner._get_source_models()
+    train_x, train_y = target_data_factory()
+    target_model = planner._get_fitted_model(train_x, train_y)
+
+    # record the dimension and seed of every Sobol engine
+    draws = []
+    draw_sobol_normal_samples = rgpe_planner.draw_sobol_normal_samples
+
+    def record_draws(d, n, seed=None, **kwargs):
+        draws.append((d, seed))
+        return draw_sobol_normal_samples(d=d, n=n, seed=seed, **kwargs)
+
+    monkeypatch.setattr(
+        rgpe_planner, "draw_sobol_normal_samples", record_draws
+    )
+    planner.compute_rank_weights(
+        train_x.float(),
+        train_y.float(),
+        planner._batched_source_model,
+        target_model,
+        num_samples=10,
+        base_train_mask=planner._source_train_mask,
+    )
+
+    # all base models share one engine with their own dimensions, the LOO
+    # models of the target model share the base samples of the other
+    n = train_x.shape[0]
+    assert [d for d, _ in draws] == [3 * n, n]
+    assert draws[0][1] != draws[1][1]
+
+
+# targets with ties
+TIED_TARGET_Y = torch.tensor([[0.3], [-1.0], [0.3], [2.0], [-1.0], [0.5]])
+
+
+@pytest.mark.parametrize(
+    "f_samps",
+    [
+        torch.randn(16, 6),
+        # samples with ties
+        torch.randint(0, 3, (16, 6)).float(),
+    ],
+)
+def test_ranking_loss_base_samples(f_samps):
+    planner = planner_factory(num_tasks=1)
+    assert torch.equal(
+        planner.compute_ranking_loss(f_samps, TIED_TARGET_Y),
+        reference_ranking_loss(f_samps, TIED_TARGET_Y),
+    )
+
+
+@pytest.mark.parametrize(
+    "f_samps",
+    [
+        torch.randn(16, 6, 6),
+        # samples with ties
+        torch.randint(0, 3, (16, 6, 6)).float(),
+    ],
+)
+def test_ranking_loss_loocv_samples(f_samps):
+    planner = planner_factory(num_tasks=1)
+    assert torch.equal(
+        planner.compute_ranking_loss(f_samps, TIED_TARGET_Y),
+        reference_ranking_loss(f_samps, TIED_TARGET_Y),
+    )
+
+
+def test_ranking_loss_model_dim():
+    planner = planner_factory(num_tasks=1)
+    num_samples, n = 16, TIED_TARGET_Y.shape[0]
+    base_f_samps = torch.randint(0, 3, (3, num_samples, n)).float()
+    loocv_f_samps = torch.randint(0, 3, (num_samples, n, n)).float()
+    # `(T + 1) x num_samples x n x n`, as built by compute_rank_weights
+    f_samps = torch.cat(
+        [
+            base_f_samps.unsqueeze(-2).expand(-1, -1, n, -1),
+            loocv_f_samps.unsqueeze(0),
+        ]
+    )
+    ranking_loss = planner.compute_ranking_loss(f_samps, TIED_TARGET_Y)
+    assert ranking_loss.shape == (4, num_samples)
+    for model_ix in range(3):
+        assert torch.equal(
+            ranking_loss[model_ix],
+            reference_ranking_loss(base_f_samps[model_ix], TIED_TARGET_Y),
+        )
+    assert torch.equal(
+        ranking_loss[-1], reference_ranking_loss(loocv_f_samps, TIED_TARGET_Y)
+    )
+
+
+def test_ranking_loss_orientation():
+    planner = planner_factory(num_tasks=1)
+    target_y = torch.tensor([[0.0], [1.0], [3.0], [2.0]])
+    n = target_y.shape[0]
+    y = target_y.squeeze(-1)
+
+    # a base model that reproduces the (asymmetric) order of the targets
+    # has no ranking loss, one that reverses it misranks all n * (n - 1)
+    # ordered pairs
+    for f_samps, expected in [(y, 0), (-y, n * (n - 1))]:
+        f_samps = f_samps.expand(2, n)
+        ranking_loss = planner.compute_ranking_loss(f_samps, target_y)
+        assert ranking_loss.tolist() == [expected, expected]
+        assert torch.equal(
+            ranking_loss, reference_ranking_loss(f_samps, target_y)
+        )
+
+    # same for the LOOCV models, whose rows hold the in-sample predictions
+    for f_samps, expected in [(y, 0), (-y, n * (n - 1))]:
+        f_samps = f_samps.expand(2, n, n)
+        ranking_loss = planner.compute_ranking_loss(f_samps, target_y)
+        assert ranking_loss.tolist() == [expected, expected]
+        assert torch.equal(
+            ranking_loss, reference_ranking_loss(f_samps, target_y)
+        )
+
+
+def test_rank_weights_few_observations(monkeypatch):
+    planner = planner_factory(num_tasks=3)
+    planner.source_models = planner._get_source_models()
+    train_x, train_y = target_data_factory(num_obs=2)
+    target_model = planner._get_fitted_model(train_x, train_y)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("ranking losses were computed")
+
+    monkeypatch.setattr(planner, "get_target_model_loocv_sample_preds", fail)
+    monkeypatch.setattr(planner, "_draw_seeds", fail)
+    rank_weights, ranking_loss = planner.compute_rank_weights(
+        train_x,
+        train_y,
+        planner._batched_source_model,
+        target_model,
+        num_samples=10,
+        base_train_mask=planner._source_train_mask,
+    )
+
+    assert rank_weights.dtype == train_x.dtype
+    assert torch.equal(
+        rank_weights, torch.full((4,), 0.25, dtype=train_x.dtype)
+    )
+    assert torch.equal(ranking_loss, torch.zeros((4, 10), dtype=torch.long))
+
+
+def rank_loss_inputs():
+    f_samps = torch.randint(0, 3, (4, 16, 6, 6)).float()
+    y = TIED_TARGET_Y.squeeze(-1)
+    return f_samps, y.unsqueeze(1) < y.unsqueeze(0)
+
+
+def test_rank_loss_eager_by_default(monkeypatch):
+    def compile(*args, **kwargs):
+        raise AssertionError("ranking loss was compiled")
+
+    monkeypatch.setattr(torch, "compile", compile)
+    planner = planner_factory(num_tasks=1)
+    f_samps, y_less = rank_loss_inputs()
+    assert torch.equal(
+        planner._rank_loss_3d(f_samps, y_less),
+        rgpe_planner._rank_loss_3d(f_samps, y_less),
+    )
+
+
+def test_rank_loss_compile_fallback(monkeypatch):
+    def compile(*args, **kwargs):
+        raise RuntimeError("torch.compile is not supported")
+
+    monkeypatch.setattr(torch, "compile", compile)
+    rank_loss_3d = _LazyCompiled(rgpe_planner._rank_loss_3d, dynamic=True)
+    f_samps, y_less = rank_loss_inputs()
+    assert torch.equal(
+        rank_loss_3d(f_samps, y_less),
+        rgpe_planner._rank_loss_3d(f_samps, y_less),
+    )
+    assert rank_loss_3d.use_eager
+
+
+def test_rank_loss_dynamo_error_fallback(monkeypatch):
+    from torch._dynamo.exc import InternalTorchDynamoError
+
+    def compiled_fn(*args):
+        raise InternalTorchDynamoError("dynamo failed")
+
+    monkeypatch.setattr(torch, "compile", lambda fn, **kwargs: compiled_fn)
+    rank_loss_3d = _LazyCompiled(rgpe_planner._rank_loss_3d, dynamic=True)
+    f_samps, y_less = rank_loss_inputs()
+    assert torch.equal(
+        rank_loss_3d(f_samps, y_less),
+        rgpe_planner._rank_loss_3d(f_samps, y_less),
+    )
+    assert rank_loss_3d.use_eager